@@ -13,46 +13,226 @@ Features:
 - Document symbols
 """
 
+import os
 import sys
 import json
 import re
-from typing import Dict, List, Any, Optional
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterator, List, Any, Optional, Tuple, Union
 from coral66_semantic_parser import CORAL66Parser, SymbolKind
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Wait this long after the last edit before reparsing (seconds)
+PARSE_DEBOUNCE_DELAY = 0.02
+
+# Number of parse results kept, keyed by a hash of the parsed text
+PARSE_CACHE_SIZE = 32
+
+# Number of documents whose parse results are kept in memory
+MAX_PARSED_DOCUMENTS = 64
+
+# JSON-RPC base protocol framing
+HEADER_TERMINATOR = b'\r\n\r\n'
+CONTENT_LENGTH_RE = re.compile(rb'content-length:\s*(\d+)', re.IGNORECASE)
+READ_CHUNK_SIZE = 65536
+
+# Line breaks, for indexing line starts
+NEWLINE_RE = re.compile('\n')
+
+# Characters outside the BMP, which take two UTF-16 code units
+ASTRAL_RE = re.compile('[\U00010000-\U0010ffff]')
+
+# Message bodies go through orjson when it is installed
+if orjson is not None:
+    decode_json = orjson.loads
+    encode_json = orjson.dumps
+else:
+    def decode_json(data: Union[bytes, memoryview]) -> Any:
+        """Parse a message body from JSON bytes"""
+        return json.loads(bytes(data))
+
+    def encode_json(obj: Any) -> bytes:
+        """Serialise a message body to compact JSON bytes"""
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+# Result of the initialize request, which never changes
+INITIALIZE_RESULT = {
+    'capabilities': {
+        'textDocumentSync': {
+            'openClose': True,
+            'change': 2,  # Incremental sync
+            'save': {'includeText': True}
+        },
+        'completionProvider': {
+            'triggerCharacters': ['.', '[', '('],
+            'resolveProvider': False
+        },
+        'hoverProvider': True,
+        'definitionProvider': True,
+        'referencesProvider': True,
+        'documentSymbolProvider': True,
+    },
+    'serverInfo': {
+        'name': 'coral66-lsp',
+        'version': '1.0.0'
+    }
+}
+
+# Fixed-shape JSON for the Location and SymbolInformation lists sent in bulk
+LOCATION_JSON = (
+    b'{"uri":%b,"range":{"start":{"line":%d,"character":%d},'
+    b'"end":{"line":%d,"character":%d}}}'
+)
+SYMBOL_INFORMATION_JSON = b'{"name":%b,"kind":%d,"location":' + LOCATION_JSON + b'}'
+
+# Parser symbol kinds mapped to LSP CompletionItemKind
+COMPLETION_KIND_MAP = {
+    'keyword': 14,  # Keyword
+    'variable': 6,  # Variable
+    'array': 6,     # Variable
+    'table': 22,    # Struct
+    'procedure': 3, # Function
+    'function': 3,  # Function
+    'switch': 13,   # Enum
+    'label': 15,    # Reference
+    'parameter': 6, # Variable
+    'element': 5,   # Field
+}
+
+# Parser symbol kinds mapped to LSP SymbolKind
+SYMBOL_KIND_MAP = {
+    'variable': 13,   # Variable
+    'array': 18,      # Array
+    'table': 23,      # Struct
+    'procedure': 12,  # Function
+    'function': 12,   # Function
+    'switch': 10,     # Enum
+    'label': 15,      # Constant (for labels)
+    'element': 8,     # Field
+    'parameter': 13,  # Variable
+    'overlay': 23,    # Struct
+}
+
+
+class PreSerialized(bytes):
+    """A handler result or response that is already encoded as JSON"""
+
+
+class TextDocument:
+    """An open document, kept in step with the client's edits"""
+
+    def __init__(self, text: str, version: int = 0):
+        self.text = text
+        self.version = version
+        self._line_starts: Optional['array[int]'] = None
+        self._has_astral: Optional[bool] = None
+
+    def _get_line_starts(self) -> 'array[int]':
+        """Offsets at which each line begins, rebuilt lazily after an edit"""
+        if self._line_starts is None:
+            self._line_starts = array('i', [0])
+            self._line_starts.extend(m.end() for m in NEWLINE_RE.finditer(self.text))
+        return self._line_starts
+
+    @property
+    def has_astral(self) -> bool:
+        """Whether any character needs a UTF-16 surrogate pair"""
+        if self._has_astral is None:
+            self._has_astral = not self.text.isascii() and ASTRAL_RE.search(self.text) is not None
+        return self._has_astral
+
+    def get_line(self, line: int) -> str:
+        """Get the text of a line, without its newline"""
+        line_starts = self._get_line_starts()
+        if line < 0 or line >= len(line_starts):
+            return ''
+        if line + 1 < len(line_starts):
+            return self.text[line_starts[line]:line_starts[line + 1] - 1]
+        return self.text[line_starts[line]:]
+
+    def to_column(self, line: int, character: int) -> int:
+        """Convert an LSP character (UTF-16 code units) to an index into the line"""
+        if not self.has_astral:
+            return character
+        encoded = self.get_line(line).encode('utf-16-le', 'surrogatepass')
+        return len(encoded[:2 * character].decode('utf-16-le', 'surrogatepass'))
+
+    def to_character(self, line: int, column: int) -> int:
+        """Convert an index into the line to an LSP character (UTF-16 code units)"""
+        if not self.has_astral:
+            return column
+        return len(self.get_line(line)[:column].encode('utf-16-le', 'surrogatepass')) // 2
+
+    def offset_at(self, line: int, character: int) -> int:
+        """Convert an LSP position to an offset into the text"""
+        line_starts = self._get_line_starts()
+        if line < 0:
+            return 0
+        if line >= len(line_starts):
+            return len(self.text)
+        start = line_starts[line]
+        if line + 1 < len(line_starts):
+            end = line_starts[line + 1] - 1
+        else:
+            end = len(self.text)
+        return min(start + self.to_column(line, max(character, 0)), end)
+
+    def apply_change(self, change: Dict) -> None:
+        """Apply one contentChanges entry, either ranged or full text"""
+        new_text = change.get('text', '')
+        change_range = change.get('range')
+        if change_range is None:
+            self.text = new_text
+        else:
+            start = change_range['start']
+            end = change_range['end']
+            start_offset = self.offset_at(start['line'], start['character'])
+            end_offset = self.offset_at(end['line'], end['character'])
+            self.text = self.text[:start_offset] + new_text + self.text[end_offset:]
+        self._line_starts = None
+        self._has_astral = None
+
 
 class CORAL66LanguageServer:
     """LSP server for CORAL 66"""
 
     def __init__(self):
-        self.documents: Dict[str, str] = {}
-        self.parsers: Dict[str, CORAL66Parser] = {}
-
-    def handle_message(self, message: Dict) -> Optional[Dict]:
+        self.documents: Dict[str, TextDocument] = {}
+        # Parsers for open documents, least recently used first
+        self.parsers: 'OrderedDict[str, CORAL66Parser]' = OrderedDict()
+        self._initialize_result = PreSerialized(encode_json(INITIALIZE_RESULT))
+        # Debounced parses not yet applied: uri -> (timer, text, text hash)
+        self._pending: Dict[str, Tuple[threading.Timer, str, bytes]] = {}
+        self._parse_cache: 'OrderedDict[bytes, CORAL66Parser]' = OrderedDict()
+        # Parses handed to the pool: uri -> (text hash, future)
+        self._parse_futures: Dict[str, Tuple[bytes, Future]] = {}
+        self._parse_pool = ThreadPoolExecutor(max_workers=2)
+        self._lock = threading.Lock()
+
+    def handle_message(self, message: Dict) -> Optional[Union[Dict, PreSerialized]]:
         """Handle an incoming JSON-RPC message"""
         method = message.get('method', '')
         params = message.get('params', {})
         msg_id = message.get('id')
 
         # Route to appropriate handler
-        handlers = {
-            'initialize': self._handle_initialize,
-            'initialized': self._handle_initialized,
-            'shutdown': self._handle_shutdown,
-            'exit': self._handle_exit,
-            'textDocument/didOpen': self._handle_did_open,
-            'textDocument/didChange': self._handle_did_change,
-            'textDocument/didClose': self._handle_did_close,
-            'textDocument/completion': self._handle_completion,
-            'textDocument/hover': self._handle_hover,
-            'textDocument/definition': self._handle_definition,
-            'textDocument/references': self._handle_references,
-            'textDocument/documentSymbol': self._handle_document_symbol,
-        }
-
-        handler = handlers.get(method)
+        handler = self._HANDLERS.get(method)
         if handler:
-            result = handler(params)
+            result = handler(self, params)
             if msg_id is not None:
+                if isinstance(result, PreSerialized):
+                    # Splice the encoded result in rather than re-serialising it
+                    return PreSerialized(
+                        b'{"jsonrpc":"2.0","id":%b,"result":%b}' % (encode_json(msg_id), result)
+                    )
                 return {'jsonrpc': '2.0', 'id': msg_id, 'result': result}
         elif msg_id is not None:
             return {
@@ -63,29 +243,9 @@ class CORAL66LanguageServer:
 
         return None
 
-    def _handle_initialize(self, params: Dict) -> Dict:
+    def _handle_initialize(self, params: Dict) -> 'PreSerialized':
         """Handle initialize request"""
-        return {
-            'capabilities': {
-                'textDocumentSync': {
-                    'openClose': True,
-                    'change': 1,  # Full sync
-                    'save': {'includeText': True}
-                },
-                'completionProvider': {
-                    'triggerCharacters': ['.', '[', '('],
-                    'resolveProvider': False
-                },
-                'hoverProvider': True,
-                'definitionProvider': True,
-                'referencesProvider': True,
-                'documentSymbolProvider': True,
-            },
-            'serverInfo': {
-                'name': 'coral66-lsp',
-                'version': '1.0.0'
-            }
-        }
+        return self._initialize_result
 
     def _handle_initialized(self, params: Dict) -> None:
         """Handle initialized notification"""
@@ -103,6 +263,8 @@ class CORAL66LanguageServer:
         """Handle textDocument/didOpen"""
         uri = params['textDocument']['uri']
         text = params['textDocument']['text']
+        version = params['textDocument'].get('version', 0)
+        self.documents[uri] = TextDocument(text, version)
         self._update_document(uri, text)
         return None
 
@@ -110,60 +272,183 @@ class CORAL66LanguageServer:
         """Handle textDocument/didChange"""
         uri = params['textDocument']['uri']
         changes = params.get('contentChanges', [])
-        if changes:
-            text = changes[0].get('text', '')
-            self._update_document(uri, text)
+        if not changes:
+            return None
+
+        doc = self.documents.get(uri)
+        if doc is None:
+            doc = self.documents[uri] = TextDocument('')
+        # Edits arrive in order, each against the result of the previous one
+        for change in changes:
+            doc.apply_change(change)
+        doc.version = params['textDocument'].get('version', doc.version)
+        self._update_document(uri, doc.text)
         return None
 
     def _handle_did_close(self, params: Dict) -> None:
         """Handle textDocument/didClose"""
         uri = params['textDocument']['uri']
+        self._cancel_pending(uri)
         if uri in self.documents:
             del self.documents[uri]
-        if uri in self.parsers:
-            del self.parsers[uri]
+        with self._lock:
+            if uri in self.parsers:
+                del self.parsers[uri]
+            self._parse_futures.pop(uri, None)
         return None
 
     def _update_document(self, uri: str, text: str) -> None:
-        """Update document and reparse"""
-        self.documents[uri] = text
+        """Schedule a reparse after a document has been opened or edited"""
+        key = self._text_key(text)
+        self._cancel_pending(uri)
+
+        # Undo/redo often lands back on text we have already parsed
+        with self._lock:
+            parser = self._parse_cache.get(key)
+            if parser is not None:
+                self._parse_cache.move_to_end(key)
+                self._install_parser(uri, parser)
+                return
+
+        timer = threading.Timer(PARSE_DEBOUNCE_DELAY, self._submit_parse, args=(uri, text, key))
+        timer.daemon = True
+        self._pending[uri] = (timer, text, key)
+        timer.start()
+
+    @staticmethod
+    def _text_key(text: str) -> bytes:
+        """Hash document text for the parse cache"""
+        return hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+    def _install_parser(self, uri: str, parser: CORAL66Parser) -> None:
+        """
+        Make parser current for uri, evicting the least recently used
+
+        Call with self._lock held.
+        """
+        self.parsers[uri] = parser
+        self.parsers.move_to_end(uri)
+        while len(self.parsers) > MAX_PARSED_DOCUMENTS:
+            evicted, _ = self.parsers.popitem(last=False)
+            self._parse_futures.pop(evicted, None)
+
+    def _cancel_pending(self, uri: str) -> None:
+        """Drop a debounced parse that has been superseded"""
+        pending = self._pending.pop(uri, None)
+        if pending is not None:
+            pending[0].cancel()
+
+    def _parse_text(self, text: str, key: bytes) -> CORAL66Parser:
+        """Parse text and remember the result under its hash"""
         parser = CORAL66Parser()
         parser.parse(text)
-        self.parsers[uri] = parser
 
-    def _handle_completion(self, params: Dict) -> List[Dict]:
+        with self._lock:
+            self._parse_cache[key] = parser
+            self._parse_cache.move_to_end(key)
+            while len(self._parse_cache) > PARSE_CACHE_SIZE:
+                self._parse_cache.popitem(last=False)
+        return parser
+
+    def _do_parse(self, uri: str, text: str, key: bytes) -> CORAL66Parser:
+        """Run a debounced parse and install it if no later edit arrived"""
+        parser = self._parse_text(text, key)
+        with self._lock:
+            pending = self._pending.get(uri)
+            if pending is not None and pending[2] == key:
+                self._install_parser(uri, parser)
+        return parser
+
+    def _submit_parse(self, uri: str, text: str, key: bytes) -> Future:
+        """Hand a parse to the worker pool, off the message loop"""
+        future = self._parse_pool.submit(self._do_parse, uri, text, key)
+        with self._lock:
+            self._parse_futures[uri] = (key, future)
+        return future
+
+    def _get_parser(self, uri: str) -> Optional[CORAL66Parser]:
+        """Get the parser for a document, finishing any debounced parse first"""
+        pending = self._pending.pop(uri, None)
+        if pending is not None:
+            timer, text, key = pending
+            timer.cancel()
+            timer.join()
+            with self._lock:
+                submitted = self._parse_futures.get(uri)
+            if submitted is not None and submitted[0] == key:
+                future = submitted[1]
+            else:
+                # The timer was cancelled before it fired
+                future = self._submit_parse(uri, text, key)
+            parser = future.result()
+            with self._lock:
+                self._install_parser(uri, parser)
+            return parser
+
+        with self._lock:
+            parser = self.parsers.get(uri)
+            if parser is not None:
+                self.parsers.move_to_end(uri)
+                return parser
+
+        doc = self.documents.get(uri)
+        if doc is None:
+            return None
+
+        # The parser was dropped to bound memory, so rebuild it from the text
+        key = self._text_key(doc.text)
+        with self._lock:
+            parser = self._parse_cache.get(key)
+        if parser is None:
+            parser = self._parse_text(doc.text, key)
+        with self._lock:
+            self._install_parser(uri, parser)
+        return parser
+
+    def _to_parser_position(self, uri: str, position: Dict) -> Tuple[int, int]:
+        """Convert an LSP position to the parser's line and column"""
+        line = position['line']
+        doc = self.documents.get(uri)
+        if doc is None:
+            return line, position['character']
+        return line, doc.to_column(line, position['character'])
+
+    def _to_lsp_spans(self, uri: str, spans: List[Tuple[int, int, int]]) -> List[Tuple[int, int, int]]:
+        """Convert (line, start column, end column) spans to UTF-16 characters"""
+        doc = self.documents.get(uri)
+        if doc is None or not doc.has_astral:
+            return spans
+        return [
+            (line, doc.to_character(line, start), doc.to_character(line, end))
+            for line, start, end in spans
+        ]
+
+    def _handle_completion(self, params: Dict) -> Union[List[Dict], Dict]:
         """Handle textDocument/completion"""
         uri = params['textDocument']['uri']
         position = params['position']
 
-        if uri not in self.parsers:
+        parser = self._get_parser(uri)
+        if parser is None:
             return []
 
-        parser = self.parsers[uri]
-        completions = parser.get_completions(position['line'], position['character'])
+        line, column = self._to_parser_position(uri, position)
+        completions = parser.get_completions(line, column)
 
         # Convert to LSP format
-        lsp_completions = []
-        for c in completions:
-            kind_map = {
-                'keyword': 14,  # Keyword
-                'variable': 6,  # Variable
-                'array': 6,     # Variable
-                'table': 22,    # Struct
-                'procedure': 3, # Function
-                'function': 3,  # Function
-                'switch': 13,   # Enum
-                'label': 15,    # Reference
-                'parameter': 6, # Variable
-                'element': 5,   # Field
-            }
-            lsp_completions.append({
+        lsp_completions = [
+            {
                 'label': c['label'],
-                'kind': kind_map.get(c['kind'], 1),
+                'kind': COMPLETION_KIND_MAP.get(c['kind'], 1),
                 'detail': c['detail'],
                 'documentation': c.get('documentation', '')
-            })
+            }
+            for c in completions
+        ]
 
+        # A narrowed list has to be asked for again as the word changes
+        if parser.completion_prefix(line, column):
+            return {'isIncomplete': True, 'items': lsp_completions}
         return lsp_completions
 
     def _handle_hover(self, params: Dict) -> Optional[Dict]:
@@ -171,11 +456,12 @@ class CORAL66LanguageServer:
         uri = params['textDocument']['uri']
         position = params['position']
 
-        if uri not in self.parsers:
+        parser = self._get_parser(uri)
+        if parser is None:
             return None
 
-        parser = self.parsers[uri]
-        hover = parser.get_hover(position['line'], position['character'])
+        line, column = self._to_parser_position(uri, position)
+        hover = parser.get_hover(line, column)
 
         if hover:
             return {
@@ -192,124 +478,163 @@ class CORAL66LanguageServer:
         uri = params['textDocument']['uri']
         position = params['position']
 
-        if uri not in self.parsers:
+        parser = self._get_parser(uri)
+        if parser is None:
             return None
 
-        parser = self.parsers[uri]
-        definition = parser.get_definition(position['line'], position['character'])
+        line, column = self._to_parser_position(uri, position)
+        definition = parser.get_definition(line, column)
 
         if definition:
+            name_start = definition['column']
+            name_end = name_start + len(definition['name'])
+            spans = self._to_lsp_spans(uri, [(definition['line'], name_start, name_end)])
+            def_line, start, end = spans[0]
             return {
                 'uri': uri,
                 'range': {
-                    'start': {'line': definition['line'], 'character': definition['column']},
-                    'end': {'line': definition['line'], 'character': definition['column'] + len(definition['name'])}
+                    'start': {'line': def_line, 'character': start},
+                    'end': {'line': def_line, 'character': end}
                 }
             }
 
         return None
 
-    def _handle_references(self, params: Dict) -> List[Dict]:
+    def _handle_references(self, params: Dict) -> Union[List[Dict], PreSerialized]:
         """Handle textDocument/references"""
         uri = params['textDocument']['uri']
         position = params['position']
 
-        if uri not in self.parsers:
+        parser = self._get_parser(uri)
+        if parser is None:
             return []
 
-        parser = self.parsers[uri]
-        refs = parser.get_references_at(position['line'], position['character'])
-
-        lsp_refs = []
-        for ref in refs:
-            lsp_refs.append({
-                'uri': uri,
-                'range': {
-                    'start': {'line': ref['line'], 'character': ref['column']},
-                    'end': {'line': ref['line'], 'character': ref['end_column']}
-                }
-            })
+        line, column = self._to_parser_position(uri, position)
+        refs = parser.get_references_at(line, column)
+        spans = self._to_lsp_spans(
+            uri, [(ref['line'], ref['column'], ref['end_column']) for ref in refs]
+        )
 
-        return lsp_refs
+        uri_json = encode_json(uri)
+        return PreSerialized(b'[%b]' % b','.join([
+            LOCATION_JSON % (uri_json, ref_line, start, ref_line, end)
+            for ref_line, start, end in spans
+        ]))
 
-    def _handle_document_symbol(self, params: Dict) -> List[Dict]:
+    def _handle_document_symbol(self, params: Dict) -> Union[List[Dict], PreSerialized]:
         """Handle textDocument/documentSymbol"""
         uri = params['textDocument']['uri']
 
-        if uri not in self.parsers:
+        parser = self._get_parser(uri)
+        if parser is None:
             return []
 
-        parser = self.parsers[uri]
-        symbols = parser.get_document_symbols()
-
-        # Map to LSP SymbolKind
-        kind_map = {
-            'variable': 13,   # Variable
-            'array': 18,      # Array
-            'table': 23,      # Struct
-            'procedure': 12,  # Function
-            'function': 12,   # Function
-            'switch': 10,     # Enum
-            'label': 15,      # Constant (for labels)
-            'element': 8,     # Field
-            'parameter': 13,  # Variable
-            'overlay': 23,    # Struct
-        }
-
-        lsp_symbols = []
-        for sym in symbols:
-            lsp_symbols.append({
-                'name': sym['name'],
-                'kind': kind_map.get(sym['kind'], 13),
-                'location': {
-                    'uri': uri,
-                    'range': {
-                        'start': {'line': sym['line'], 'character': sym['column']},
-                        'end': {'line': sym['line'], 'character': sym['column'] + len(sym['name'])}
-                    }
-                }
-            })
-
-        return lsp_symbols
+        table = parser.get_symbol_table()
+        spans = self._to_lsp_spans(uri, [
+            (line, column, column + len(name))
+            for name, line, column in zip(table.names, table.lines, table.columns)
+        ])
+
+        uri_json = encode_json(uri)
+        return PreSerialized(b'[%b]' % b','.join([
+            SYMBOL_INFORMATION_JSON % (
+                encode_json(name), SYMBOL_KIND_MAP.get(kind, 13), uri_json, line, start, line, end
+            )
+            for name, kind, (line, start, end) in zip(table.names, table.kinds, spans)
+        ]))
+
+    # Handlers by JSON-RPC method name, built once for the class
+    _HANDLERS = {
+        'initialize': _handle_initialize,
+        'initialized': _handle_initialized,
+        'shutdown': _handle_shutdown,
+        'exit': _handle_exit,
+        'textDocument/didOpen': _handle_did_open,
+        'textDocument/didChange': _handle_did_change,
+        'textDocument/didClose': _handle_did_close,
+        'textDocument/completion': _handle_completion,
+        'textDocument/hover': _handle_hover,
+        'textDocument/definition': _handle_definition,
+        'textDocument/references': _handle_references,
+        'textDocument/documentSymbol': _handle_document_symbol,
+    }
+
+
+def read_messages(stream) -> Iterator[memoryview]:
+    """
+    Yield each JSON-RPC message body read from a binary stream
+
+    Bodies are views into a receive buffer that is reused between
+    messages, so each one is only valid until the next is requested.
+    """
+    buffer = bytearray()
+    while True:
+        # Gather input until the blank line that ends the header
+        header_end = buffer.find(HEADER_TERMINATOR)
+        while header_end < 0:
+            chunk = stream.read1(READ_CHUNK_SIZE)
+            if not chunk:
+                return
+            scan_from = max(len(buffer) - len(HEADER_TERMINATOR) + 1, 0)
+            buffer += chunk
+            header_end = buffer.find(HEADER_TERMINATOR, scan_from)
+
+        match = CONTENT_LENGTH_RE.search(buffer, 0, header_end)
+        content_length = int(match.group(1)) if match else 0
+        body_start = header_end + len(HEADER_TERMINATOR)
+        body_end = body_start + content_length
+
+        # Read the rest of the body
+        while len(buffer) < body_end:
+            chunk = stream.read1(max(body_end - len(buffer), READ_CHUNK_SIZE))
+            if not chunk:
+                return
+            buffer += chunk
+
+        if content_length:
+            with memoryview(buffer) as view, view[body_start:body_end] as body:
+                yield body
+
+        # Deleting from the front of a bytearray just moves its start
+        del buffer[:body_end]
+
+
+def write_message(stream, body: bytes) -> None:
+    """Write one framed JSON-RPC message to a binary stream"""
+    header = b'Content-Length: %d\r\n\r\n' % len(body)
+    if not hasattr(os, 'writev'):
+        stream.write(header + body)
+        stream.flush()
+        return
+
+    # Gather header and body into a single system call
+    fd = stream.fileno()
+    written = os.writev(fd, [header, body])
+    if written < len(header) + len(body):
+        remaining = memoryview(header + body)[written:]
+        while remaining:
+            remaining = remaining[os.write(fd, remaining):]
 
 
 def main():
     """Main entry point for the LSP server"""
     server = CORAL66LanguageServer()
+    stdout = sys.stdout.buffer
 
-    while True:
+    for content in read_messages(sys.stdin.buffer):
         try:
-            # Read Content-Length header
-            header = ''
-            while True:
-                line = sys.stdin.readline()
-                if not line:
-                    sys.exit(0)
-                if line == '\r\n' or line == '\n':
-                    break
-                header += line
-
-            # Parse content length
-            content_length = 0
-            for line in header.split('\n'):
-                if line.lower().startswith('content-length:'):
-                    content_length = int(line.split(':')[1].strip())
-
-            if content_length == 0:
-                continue
-
-            # Read content
-            content = sys.stdin.read(content_length)
-            message = json.loads(content)
+            message = decode_json(content)
 
             # Handle message
             response = server.handle_message(message)
 
             # Send response
             if response:
-                response_str = json.dumps(response)
-                sys.stdout.write(f'Content-Length: {len(response_str)}\r\n\r\n{response_str}')
-                sys.stdout.flush()
+                if isinstance(response, PreSerialized):
+                    body = response
+                else:
+                    body = encode_json(response)
+                write_message(stdout, body)
 
         except Exception as e:
             sys.stderr.write(f'Error: {e}\n')
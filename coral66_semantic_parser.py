@@ -9,9 +9,68 @@ Reference: XGC CORAL 66 Language Reference Manual (Crown Copyright 1970)
 """
 
 import re
-from typing import List, Dict, Tuple, Optional, Set
+import string
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from heapq import merge
+from typing import List, Dict, Tuple, Optional, Sequence, Set
 from dataclasses import dataclass, field
 from enum import Enum
+from functools import cached_property
+
+
+# The partial identifier immediately before a cursor
+IDENTIFIER_PREFIX_RE = re.compile(r'\b[a-zA-Z][a-zA-Z0-9]*$')
+
+# Identifier and comma-separated identifier list
+_IDENT = r'[a-zA-Z][a-zA-Z0-9]*'
+_IDENT_LIST = rf'{_IDENT}(?:\s*,\s*{_IDENT})*'
+_IDENT_RE = re.compile(_IDENT)
+_IDENT_CHARS = frozenset(string.ascii_letters + string.digits)
+
+# FIXED(totalbits, fractionbits), with its groups prefixed by a form name
+_FIXED_TYPE = r'FIXED\s*\(\s*(?P<{0}_total>\d+)\s*,\s*(?P<{0}_fraction>-?\d+)\s*\)'
+
+# Declarations, tried in order at a declaration keyword. Each consumes
+# only its leading keywords and reads the rest of the form through a
+# lookahead, so the names inside are scanned again as identifiers. Each
+# alternative is wrapped in one outer group, which closes last and so
+# names the alternative in Match.lastgroup. Bracketed parts stop at the
+# next bracket or semicolon rather than running on through the file
+# when the closing bracket has not been typed yet
+_DECLARATION_SPECS = [
+    ('table', rf'TABLE(?=\s+(?P<table_name>{_IDENT})\s*\[\s*(?P<table_width>\d+)\s*,\s*(?P<table_length>\d+)\s*\]\s*\[(?P<table_elements>[^\[\]]*)\])'),
+    ('switch', rf'SWITCH(?=\s+(?P<switch_name>{_IDENT})\s*:=\s*(?P<switch_labels>{_IDENT_LIST}))'),
+    ('overlay', rf'OVERLAY(?=\s+(?P<overlay_base>{_IDENT}(?:\s*\[[^\[\];]*\])?)\s+WITH\s+)'),
+    ('array', rf'(?:(?P<array_type>INTEGER|FLOATING)|{_FIXED_TYPE.format("array")})\s+ARRAY(?=\s+(?P<array_name>{_IDENT})\s*\[(?P<array_dims>[^\[\];]+)\])'),
+    ('procedure', rf'(?P<proc_type>INTEGER|FLOATING|FIXED\s*\([^();]+\))?\s*(?P<proc_recursive>RECURSIVE\s+)?PROCEDURE(?=\s+(?P<proc_name>{_IDENT})\s*(?:\((?P<proc_params>[^()]*)\))?\s*;)'),
+    ('number', rf'(?:(?P<number_type>INTEGER|FLOATING)|{_FIXED_TYPE.format("number")})(?=\s+(?P<number_ids>{_IDENT_LIST}))'),
+]
+_DECLARATION_RE = re.compile(
+    '|'.join(f'(?P<{name}>{pattern})' for name, pattern in _DECLARATION_SPECS),
+    re.IGNORECASE
+)
+
+# Words, with the colon that makes a word a label (but not :=)
+_WORD_RE = re.compile(rf'\b({_IDENT})\b(\s*:(?!=))?')
+
+# Classification of a keyword spelling that begins a declaration
+_DECLARING = ''
+
+# Patterns used outside the main scan
+_NEWLINE_RE = re.compile('\n')
+_NOT_NEWLINE_RE = re.compile('[^\n]')
+_COMMENT_RE = re.compile(r'\bCOMMENT\b[^;]*;', re.IGNORECASE)
+# A bare literal lets re search for it directly, where the leading \b
+# above would have every position tried against the whole pattern
+_COMMENT_KEYWORD_RE = re.compile('COMMENT', re.IGNORECASE)
+_TABLE_ELEMENT_RE = re.compile(
+    rf'({_IDENT})\s+(INTEGER|FLOATING|FIXED\s*\([^)]+\)|UNSIGNED\s*\([^)]+\))\s+(-?\d+)(?:\s*,\s*(\d+))?',
+    re.IGNORECASE
+)
+_PARAMETER_IDS_RE = re.compile(rf':\s*({_IDENT_LIST})')
 
 
 class SymbolKind(Enum):
@@ -40,9 +99,26 @@ class Symbol:
     end_column: int = 0
     scope: str = "global"
     documentation: str = ""
-    parameters: List[str] = field(default_factory=list)
-    dimensions: List[str] = field(default_factory=list)
-    elements: List[str] = field(default_factory=list)
+    # Most symbols have none of these, so they share an empty tuple
+    parameters: Sequence[str] = ()
+    dimensions: Sequence[str] = ()
+    elements: Sequence[str] = ()
+
+    @cached_property
+    def hover(self) -> Dict:
+        """Hover content, built the first time the symbol is hovered"""
+        return {
+            'contents': f"**{self.name}**: {self.data_type}\n\n{self.documentation}"
+        }
+
+    @cached_property
+    def definition(self) -> Dict:
+        """Definition location, built the first time it is asked for"""
+        return {
+            'line': self.line,
+            'column': self.column,
+            'name': self.name
+        }
 
 
 @dataclass
@@ -55,6 +131,31 @@ class Reference:
     context: str = ""
 
 
+@dataclass
+class ReferenceTable:
+    """Identifier references in text order, stored as parallel columns"""
+    names: List[str] = field(default_factory=list)
+    lines: 'array[int]' = field(default_factory=lambda: array('i'))
+    columns: 'array[int]' = field(default_factory=lambda: array('i'))
+    end_columns: 'array[int]' = field(default_factory=lambda: array('i'))
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+
+@dataclass
+class SymbolTable:
+    """Top-level symbols in line order, stored as parallel columns"""
+    names: List[str] = field(default_factory=list)
+    kinds: List[str] = field(default_factory=list)
+    details: List[str] = field(default_factory=list)
+    lines: List[int] = field(default_factory=list)
+    columns: List[int] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+
 @dataclass
 class Diagnostic:
     """A diagnostic message"""
@@ -102,6 +203,31 @@ class CORAL66Parser:
         'CODE',
     }
 
+    # Keywords as they appear in lowercased names
+    _KEYWORDS_LOWER = frozenset(keyword.lower() for keyword in KEYWORDS)
+
+    # Keywords that can begin a declaration
+    _DECLARATION_KEYWORDS = frozenset({
+        'table', 'switch', 'overlay', 'fixed', 'integer', 'floating', 'recursive', 'procedure'
+    })
+
+    # Keyword hover content by lowercased keyword
+    _KEYWORD_HOVERS = {
+        kw.lower(): {'contents': f"**{kw}**\n\nCORAL 66 keyword"}
+        for kw in KEYWORDS
+    }
+
+    # Keyword completion items, the same for every document
+    _KEYWORD_COMPLETIONS = [
+        {
+            'label': kw,
+            'kind': 'keyword',
+            'detail': 'CORAL 66 keyword',
+            'documentation': f"CORAL 66 keyword: {kw}"
+        }
+        for kw in sorted(KEYWORDS)
+    ]
+
     # Operators
     OPERATORS = {
         ':=': 'assignment',
@@ -117,364 +243,419 @@ class CORAL66Parser:
         '<>': 'not equal',
     }
 
+    # Identifier spelling -> lowercase name, _DECLARING for a keyword that
+    # begins a declaration, or None for any other keyword. Shared by all
+    # parsers, so a reparse after each edit finds them already populated
+    _spellings: Dict[str, Optional[str]] = {}
+    _SPELLINGS_LIMIT = 65536
+
+    # One shared copy of each data type string, for the same reason
+    _data_types: Dict[str, str] = {}
+
+    # Number of recent position lookups remembered by _resolve
+    _RESOLVED_LIMIT = 16
+
     def __init__(self):
         self.symbols: Dict[str, Symbol] = {}
-        self.references: List[Reference] = []
+        self._definitions: Dict[str, List[Symbol]] = {}
+        self.references: ReferenceTable = ReferenceTable()
         self.diagnostics: List[Diagnostic] = []
-        self.lines: List[str] = []
-        self.current_scope: str = "global"
-        self.scope_stack: List[str] = ["global"]
+        self.text: str = ""
+        self.line_starts: 'array[int]' = array('i', [0])
+        self._completions: Optional[List[Dict]] = None
+        self._refs_by_name: Optional[Dict[str, List[int]]] = None
+        self._symbol_table: Optional[SymbolTable] = None
+        self._document_symbols: Optional[List[Dict]] = None
+        self._completions_by_label: List[Dict] = []
+        self._completion_labels: List[str] = []
+        self._resolved: 'OrderedDict[Tuple[int, int], Optional[str]]' = OrderedDict()
 
     def parse(self, text: str) -> None:
         """Parse CORAL 66 source code"""
         self.symbols = {}
-        self.references = []
+        self._definitions = {}
+        self.references = ReferenceTable()
         self.diagnostics = []
-        self.lines = text.split('\n')
-        self.current_scope = "global"
-        self.scope_stack = ["global"]
-
-        # Remove comments first
+        self.text = text
+        self.line_starts = array('i', [0])
+        self.line_starts.extend(m.end() for m in _NEWLINE_RE.finditer(text))
+        self._completions = None
+        self._refs_by_name = None
+        self._symbol_table = None
+        self._document_symbols = None
+        self._resolved = OrderedDict()
+
+        # Blank out comments first
         cleaned_text = self._remove_comments(text)
 
-        # Parse declarations
-        self._parse_number_declarations(cleaned_text)
-        self._parse_array_declarations(cleaned_text)
-        self._parse_table_declarations(cleaned_text)
-        self._parse_procedure_declarations(cleaned_text)
-        self._parse_switch_declarations(cleaned_text)
-        self._parse_overlay_declarations(cleaned_text)
-        self._parse_labels(cleaned_text)
+        # Collect declarations and references in a single scan
+        self._scan(cleaned_text)
+
+    def _scan(self, text: str) -> None:
+        """
+        Scan the text once, collecting declarations and references
+
+        Only words are matched against the text as a whole; the
+        declaration patterns are tried just where a keyword starts, so
+        most of the text is never looked at by more than one pattern.
+        """
+        # Matches arrive in order, so track the line as we go rather
+        # than recounting newlines from the start of the text each time
+        line = 0
+        line_start = 0
+        scanned = 0
+
+        # Keywords already taken by the last declaration matched
+        declared_to = 0
+
+        # The same spellings recur throughout a file and across reparses,
+        # so each one is only classified the first time it is seen
+        spellings = self._spellings
+        if len(spellings) > self._SPELLINGS_LIMIT:
+            spellings.clear()
+        if len(self._data_types) > self._SPELLINGS_LIMIT:
+            self._data_types.clear()
+
+        # Look up the calls made for every word once
+        count = text.count
+        rfind = text.rfind
+        match_declaration = _DECLARATION_RE.match
+
+        # Append straight to the reference columns
+        add_name = self.references.names.append
+        add_line = self.references.lines.append
+        add_column = self.references.columns.append
+        add_end_column = self.references.end_columns.append
+        for match in _WORD_RE.finditer(text):
+            spelling = match.group(1)
+            try:
+                name = spellings[spelling]
+            except KeyError:
+                name = sys.intern(spelling.lower())
+                if name in self._DECLARATION_KEYWORDS:
+                    name = _DECLARING
+                elif name in self._KEYWORDS_LOWER:
+                    name = None
+                spellings[spelling] = name
+
+            start = match.start()
+            if not name:
+                # Skip other keywords
+                if name is None or start < declared_to:
+                    continue
+                declaration = match_declaration(text, start)
+                if declaration is None:
+                    continue
+                declared_to = declaration.end()
+
+            newlines = count('\n', scanned, start)
+            if newlines:
+                line += newlines
+                line_start = rfind('\n', scanned, start) + 1
+            scanned = start
+            col = start - line_start
+
+            if not name:
+                self._DECLARATION_HANDLERS[declaration.lastgroup](self, declaration, line, col)
+                continue
 
-        # Parse references
-        self._parse_references(cleaned_text)
+            if match.group(2):
+                self._declare_label(name, line, col)
+            add_name(name)
+            add_line(line)
+            add_column(col)
+            add_end_column(col + len(name))
 
     def _remove_comments(self, text: str) -> str:
-        """Remove CORAL 66 comments"""
-        # COMMENT ... ; style comments
-        text = re.sub(r'\bCOMMENT\b[^;]*;', '', text, flags=re.IGNORECASE)
+        """
+        Blank out CORAL 66 comments
+
+        Comments are overwritten with spaces, keeping their line breaks, so
+        every offset in the result is the same as in the original text.
+        """
+        # COMMENT ... ; style comments, checked only where the word occurs
+        pieces = []
+        copied = 0
+        for candidate in _COMMENT_KEYWORD_RE.finditer(text):
+            if candidate.start() < copied:
+                continue
+            # Nothing after this point can close a comment
+            end = text.find(';', candidate.end())
+            if end < 0:
+                break
+            match = _COMMENT_RE.match(text, candidate.start(), end + 1)
+            if match is None:
+                continue
+            comment = match.group()
+            pieces.append(text[copied:match.start()])
+            if '\n' in comment:
+                pieces.append(_NOT_NEWLINE_RE.sub(' ', comment))
+            else:
+                pieces.append(' ' * len(comment))
+            copied = match.end()
+
         # Bracketed comments are kept as they're part of syntax
-        return text
+        if not pieces:
+            return text
+        pieces.append(text[copied:])
+        return ''.join(pieces)
 
-    def _find_position(self, text: str, match_start: int) -> Tuple[int, int]:
+    def _find_position(self, match_start: int) -> Tuple[int, int]:
         """Convert character offset to line and column"""
-        line = text[:match_start].count('\n')
-        last_newline = text.rfind('\n', 0, match_start)
-        column = match_start - last_newline - 1 if last_newline >= 0 else match_start
-        return (line, column)
+        line = bisect_right(self.line_starts, match_start) - 1
+        return (line, match_start - self.line_starts[line])
 
-    def _parse_number_declarations(self, text: str) -> None:
+    def _declare_number(self, match: re.Match, line: int, col: int) -> None:
         """
-        Parse number declarations:
+        Number declarations:
         INTEGER id1, id2 := value
         FLOATING id1, id2
         FIXED(totalbits, fractionbits) id1, id2 := value
         """
-        # INTEGER declarations
-        pattern = r'\b(INTEGER)\s+([a-zA-Z][a-zA-Z0-9]*(?:\s*,\s*[a-zA-Z][a-zA-Z0-9]*)*)(?:\s*:=\s*([^;]+))?'
-        for match in re.finditer(pattern, text, re.IGNORECASE):
-            type_name = match.group(1).upper()
-            id_list = match.group(2)
-            preset = match.group(3)
-
-            ids = [id.strip() for id in id_list.split(',')]
-            for id_name in ids:
-                if id_name and not id_name.upper() in self.KEYWORDS:
-                    line, col = self._find_position(text, match.start())
-                    self.symbols[id_name.lower()] = Symbol(
-                        name=id_name.lower(),
-                        kind=SymbolKind.VARIABLE,
-                        data_type=type_name,
-                        line=line,
-                        column=col,
-                        documentation=f"{type_name} variable"
-                    )
-
-        # FLOATING declarations
-        pattern = r'\b(FLOATING)\s+([a-zA-Z][a-zA-Z0-9]*(?:\s*,\s*[a-zA-Z][a-zA-Z0-9]*)*)(?:\s*:=\s*([^;]+))?'
-        for match in re.finditer(pattern, text, re.IGNORECASE):
-            type_name = match.group(1).upper()
-            id_list = match.group(2)
-
-            ids = [id.strip() for id in id_list.split(',')]
-            for id_name in ids:
-                if id_name and not id_name.upper() in self.KEYWORDS:
-                    line, col = self._find_position(text, match.start())
-                    self.symbols[id_name.lower()] = Symbol(
-                        name=id_name.lower(),
-                        kind=SymbolKind.VARIABLE,
-                        data_type=type_name,
-                        line=line,
-                        column=col,
-                        documentation=f"{type_name} variable"
-                    )
-
-        # FIXED(totalbits, fractionbits) declarations
-        pattern = r'\b(FIXED)\s*\(\s*(\d+)\s*,\s*(-?\d+)\s*\)\s+([a-zA-Z][a-zA-Z0-9]*(?:\s*,\s*[a-zA-Z][a-zA-Z0-9]*)*)(?:\s*:=\s*([^;]+))?'
-        for match in re.finditer(pattern, text, re.IGNORECASE):
-            totalbits = match.group(2)
-            fractionbits = match.group(3)
-            id_list = match.group(4)
-            type_name = f"FIXED({totalbits},{fractionbits})"
+        number_type = match.group('number_type')
+        if number_type:
+            type_name = self._data_type(number_type.upper())
+            documentation = f"{type_name} variable"
+        else:
+            totalbits = match.group('number_total')
+            fractionbits = match.group('number_fraction')
+            type_name = self._data_type(f"FIXED({totalbits},{fractionbits})")
+            documentation = f"Fixed-point variable: {totalbits} total bits, {fractionbits} fraction bits"
+        id_list = match.group('number_ids')
+
+        for id_match in _IDENT_RE.finditer(id_list):
+            id_name = sys.intern(id_match.group().lower())
+            if id_name not in self._KEYWORDS_LOWER:
+                self._define(id_name, Symbol(
+                    name=id_name,
+                    kind=SymbolKind.VARIABLE,
+                    data_type=type_name,
+                    line=line,
+                    column=col,
+                    documentation=documentation
+                ))
 
-            ids = [id.strip() for id in id_list.split(',')]
-            for id_name in ids:
-                if id_name and not id_name.upper() in self.KEYWORDS:
-                    line, col = self._find_position(text, match.start())
-                    self.symbols[id_name.lower()] = Symbol(
-                        name=id_name.lower(),
-                        kind=SymbolKind.VARIABLE,
-                        data_type=type_name,
-                        line=line,
-                        column=col,
-                        documentation=f"Fixed-point variable: {totalbits} total bits, {fractionbits} fraction bits"
-                    )
-
-    def _parse_array_declarations(self, text: str) -> None:
+    def _declare_array(self, match: re.Match, line: int, col: int) -> None:
         """
-        Parse array declarations:
+        Array declarations:
         FLOATING ARRAY name[lower:upper]
         INTEGER ARRAY name[l1:u1, l2:u2]
         FIXED(t,f) ARRAY name[lower:upper] := values
         """
-        # Number type ARRAY pattern
-        pattern = r'\b(INTEGER|FLOATING)\s+ARRAY\s+([a-zA-Z][a-zA-Z0-9]*)\s*\[([^\]]+)\]'
-        for match in re.finditer(pattern, text, re.IGNORECASE):
-            type_name = match.group(1).upper()
-            array_name = match.group(2)
-            dimensions = match.group(3)
-
-            line, col = self._find_position(text, match.start())
-            self.symbols[array_name.lower()] = Symbol(
-                name=array_name.lower(),
-                kind=SymbolKind.ARRAY,
-                data_type=f"{type_name} ARRAY",
-                line=line,
-                column=col,
-                dimensions=[d.strip() for d in dimensions.split(',')],
-                documentation=f"{type_name} array with dimensions [{dimensions}]"
-            )
-
-        # FIXED ARRAY pattern
-        pattern = r'\b(FIXED)\s*\(\s*(\d+)\s*,\s*(-?\d+)\s*\)\s+ARRAY\s+([a-zA-Z][a-zA-Z0-9]*)\s*\[([^\]]+)\]'
-        for match in re.finditer(pattern, text, re.IGNORECASE):
-            totalbits = match.group(2)
-            fractionbits = match.group(3)
-            array_name = match.group(4)
-            dimensions = match.group(5)
+        array_name = match.group('array_name')
+        dimensions = match.group('array_dims')
+        array_type = match.group('array_type')
+        if array_type:
+            type_name = array_type.upper()
+            documentation = f"{type_name} array with dimensions [{dimensions}]"
+        else:
+            totalbits = match.group('array_total')
+            fractionbits = match.group('array_fraction')
             type_name = f"FIXED({totalbits},{fractionbits})"
-
-            line, col = self._find_position(text, match.start())
-            self.symbols[array_name.lower()] = Symbol(
-                name=array_name.lower(),
-                kind=SymbolKind.ARRAY,
-                data_type=f"{type_name} ARRAY",
-                line=line,
-                column=col,
-                dimensions=[d.strip() for d in dimensions.split(',')],
-                documentation=f"Fixed-point array [{dimensions}]: {totalbits} bits, {fractionbits} fraction bits"
-            )
-
-    def _parse_table_declarations(self, text: str) -> None:
+            documentation = f"Fixed-point array [{dimensions}]: {totalbits} bits, {fractionbits} fraction bits"
+
+        array_key = sys.intern(array_name.lower())
+        self._define(array_key, Symbol(
+            name=array_key,
+            kind=SymbolKind.ARRAY,
+            data_type=self._data_type(f"{type_name} ARRAY"),
+            line=line,
+            column=col,
+            dimensions=[d.strip() for d in dimensions.split(',')],
+            documentation=documentation
+        ))
+
+    def _declare_table(self, match: re.Match, line: int, col: int) -> None:
         """
-        Parse table declarations:
+        Table declarations:
         TABLE name[width, length][
             element type wordpos;
             element type wordpos, bitpos
         ]
         """
-        pattern = r'\bTABLE\s+([a-zA-Z][a-zA-Z0-9]*)\s*\[\s*(\d+)\s*,\s*(\d+)\s*\]\s*\[([^\]]*)\]'
-        for match in re.finditer(pattern, text, re.IGNORECASE | re.DOTALL):
-            table_name = match.group(1)
-            width = match.group(2)
-            length = match.group(3)
-            elements_text = match.group(4)
-
-            line, col = self._find_position(text, match.start())
-
-            # Parse elements
-            elements = []
-            for elem_match in re.finditer(
-                r'([a-zA-Z][a-zA-Z0-9]*)\s+(INTEGER|FLOATING|FIXED\s*\([^)]+\)|UNSIGNED\s*\([^)]+\))\s+(-?\d+)(?:\s*,\s*(\d+))?',
-                elements_text,
-                re.IGNORECASE
-            ):
-                elem_name = elem_match.group(1)
-                elem_type = elem_match.group(2)
-                elements.append(elem_name.lower())
-
-                # Add element as a symbol
-                elem_line, elem_col = self._find_position(text, match.start() + elements_text.find(elem_match.group(0)))
-                self.symbols[f"{table_name.lower()}.{elem_name.lower()}"] = Symbol(
-                    name=elem_name.lower(),
-                    kind=SymbolKind.ELEMENT,
-                    data_type=elem_type.upper(),
-                    line=elem_line,
-                    column=elem_col,
-                    scope=table_name.lower(),
-                    documentation=f"Element of TABLE {table_name}"
-                )
-
-            self.symbols[table_name.lower()] = Symbol(
-                name=table_name.lower(),
-                kind=SymbolKind.TABLE,
-                data_type=f"TABLE[{width},{length}]",
-                line=line,
-                column=col,
-                elements=elements,
-                documentation=f"Table with width {width}, length {length}"
-            )
+        table_name = match.group('table_name')
+        width = match.group('table_width')
+        length = match.group('table_length')
+        elements_text = match.group('table_elements')
+        elements_offset = match.start('table_elements')
+        table_key = sys.intern(table_name.lower())
+
+        # Parse elements
+        elements = []
+        for elem_match in _TABLE_ELEMENT_RE.finditer(elements_text):
+            elem_name = sys.intern(elem_match.group(1).lower())
+            elem_type = elem_match.group(2)
+            elements.append(elem_name)
+
+            # Add element as a symbol
+            elem_line, elem_col = self._find_position(elements_offset + elem_match.start())
+            self._define(f"{table_key}.{elem_name}", Symbol(
+                name=elem_name,
+                kind=SymbolKind.ELEMENT,
+                data_type=self._data_type(elem_type.upper()),
+                line=elem_line,
+                column=elem_col,
+                scope=table_key,
+                documentation=f"Element of TABLE {table_name}"
+            ))
 
-    def _parse_procedure_declarations(self, text: str) -> None:
+        self._define(table_key, Symbol(
+            name=table_key,
+            kind=SymbolKind.TABLE,
+            data_type=self._data_type(f"TABLE[{width},{length}]"),
+            line=line,
+            column=col,
+            elements=elements,
+            documentation=f"Table with width {width}, length {length}"
+        ))
+
+    def _declare_procedure(self, match: re.Match, line: int, col: int) -> None:
         """
-        Parse procedure declarations:
+        Procedure declarations:
         INTEGER PROCEDURE name(params); body
         FLOATING PROCEDURE name; body
         PROCEDURE name(params); body (void return)
         RECURSIVE with any of the above
         """
-        # Pattern for typed procedures with parameters
-        pattern = r'\b(INTEGER|FLOATING|FIXED\s*\([^)]+\))?\s*(RECURSIVE\s+)?PROCEDURE\s+([a-zA-Z][a-zA-Z0-9]*)\s*(?:\(([^)]*)\))?\s*;'
-        for match in re.finditer(pattern, text, re.IGNORECASE):
-            return_type = match.group(1)
-            is_recursive = match.group(2) is not None
-            proc_name = match.group(3)
-            params_text = match.group(4)
-
-            if return_type:
-                kind = SymbolKind.FUNCTION
-                type_str = return_type.upper() + " PROCEDURE"
-            else:
-                kind = SymbolKind.PROCEDURE
-                type_str = "PROCEDURE"
-
-            if is_recursive:
-                type_str = "RECURSIVE " + type_str
-
-            line, col = self._find_position(text, match.start())
-
-            # Parse parameters
-            params = []
-            if params_text:
-                # Parameters can be: VALUE type: id, id; LOCATION type: id
-                param_parts = params_text.split(';')
-                for part in param_parts:
-                    part = part.strip()
-                    if part:
-                        # Extract identifiers from parameter specification
-                        id_match = re.search(r':\s*([a-zA-Z][a-zA-Z0-9]*(?:\s*,\s*[a-zA-Z][a-zA-Z0-9]*)*)', part)
-                        if id_match:
-                            ids = [i.strip() for i in id_match.group(1).split(',')]
-                            params.extend(ids)
-
-                            # Add parameters as symbols in procedure scope
-                            for param_name in ids:
-                                self.symbols[f"{proc_name.lower()}.{param_name.lower()}"] = Symbol(
-                                    name=param_name.lower(),
-                                    kind=SymbolKind.PARAMETER,
-                                    data_type="parameter",
-                                    line=line,
-                                    column=col,
-                                    scope=proc_name.lower(),
-                                    documentation=f"Parameter of {proc_name}"
-                                )
-
-            self.symbols[proc_name.lower()] = Symbol(
-                name=proc_name.lower(),
-                kind=kind,
-                data_type=type_str,
-                line=line,
-                column=col,
-                parameters=params,
-                documentation=f"{type_str} - {'returns ' + return_type.upper() if return_type else 'no return value'}"
-            )
-
-    def _parse_switch_declarations(self, text: str) -> None:
+        return_type = match.group('proc_type')
+        is_recursive = match.group('proc_recursive') is not None
+        proc_name = match.group('proc_name')
+        params_text = match.group('proc_params')
+        proc_key = sys.intern(proc_name.lower())
+
+        if return_type:
+            kind = SymbolKind.FUNCTION
+            type_str = return_type.upper() + " PROCEDURE"
+        else:
+            kind = SymbolKind.PROCEDURE
+            type_str = "PROCEDURE"
+
+        if is_recursive:
+            type_str = "RECURSIVE " + type_str
+        type_str = self._data_type(type_str)
+
+        # Parse parameters
+        params = []
+        if params_text:
+            # Parameters can be: VALUE type: id, id; LOCATION type: id
+            param_parts = params_text.split(';')
+            for part in param_parts:
+                part = part.strip()
+                if part:
+                    # Extract identifiers from parameter specification
+                    id_match = _PARAMETER_IDS_RE.search(part)
+                    if id_match:
+                        ids = _IDENT_RE.findall(id_match.group(1))
+                        params.extend(ids)
+
+                        # Add parameters as symbols in procedure scope
+                        for param_name in ids:
+                            param_key = sys.intern(param_name.lower())
+                            self._define(f"{proc_key}.{param_key}", Symbol(
+                                name=param_key,
+                                kind=SymbolKind.PARAMETER,
+                                data_type="parameter",
+                                line=line,
+                                column=col,
+                                scope=proc_key,
+                                documentation=f"Parameter of {proc_name}"
+                            ))
+
+        self._define(proc_key, Symbol(
+            name=proc_key,
+            kind=kind,
+            data_type=type_str,
+            line=line,
+            column=col,
+            parameters=params,
+            documentation=f"{type_str} - {'returns ' + return_type.upper() if return_type else 'no return value'}"
+        ))
+
+    def _declare_switch(self, match: re.Match, line: int, col: int) -> None:
         """
-        Parse switch declarations:
+        Switch declarations:
         SWITCH name := label1, label2, label3
         """
-        pattern = r'\bSWITCH\s+([a-zA-Z][a-zA-Z0-9]*)\s*:=\s*([a-zA-Z][a-zA-Z0-9]*(?:\s*,\s*[a-zA-Z][a-zA-Z0-9]*)*)'
-        for match in re.finditer(pattern, text, re.IGNORECASE):
-            switch_name = match.group(1)
-            labels_text = match.group(2)
-
-            labels = [l.strip() for l in labels_text.split(',')]
-
-            line, col = self._find_position(text, match.start())
-            self.symbols[switch_name.lower()] = Symbol(
-                name=switch_name.lower(),
-                kind=SymbolKind.SWITCH,
-                data_type="SWITCH",
-                line=line,
-                column=col,
-                elements=labels,
-                documentation=f"Switch with labels: {', '.join(labels)}"
-            )
-
-    def _parse_overlay_declarations(self, text: str) -> None:
+        switch_name = match.group('switch_name')
+        labels_text = match.group('switch_labels')
+
+        labels = _IDENT_RE.findall(labels_text)
+
+        switch_key = sys.intern(switch_name.lower())
+        self._define(switch_key, Symbol(
+            name=switch_key,
+            kind=SymbolKind.SWITCH,
+            data_type="SWITCH",
+            line=line,
+            column=col,
+            elements=labels,
+            documentation=f"Switch with labels: {', '.join(labels)}"
+        ))
+
+    def _declare_overlay(self, match: re.Match, line: int, col: int) -> None:
         """
-        Parse overlay declarations:
+        Overlay declarations:
         OVERLAY base WITH datadec
         """
-        pattern = r'\bOVERLAY\s+([a-zA-Z][a-zA-Z0-9]*(?:\s*\[[^\]]*\])?)\s+WITH\s+'
-        for match in re.finditer(pattern, text, re.IGNORECASE):
-            base = match.group(1)
-
-            line, col = self._find_position(text, match.start())
-            # Use a unique key for overlays
-            overlay_key = f"overlay_{line}_{col}"
-            self.symbols[overlay_key] = Symbol(
-                name=base.lower(),
-                kind=SymbolKind.OVERLAY,
-                data_type="OVERLAY",
-                line=line,
-                column=col,
-                documentation=f"Overlay on {base}"
-            )
-
-    def _parse_labels(self, text: str) -> None:
+        base = match.group('overlay_base')
+
+        # Use a unique key for overlays
+        overlay_key = f"overlay_{line}_{col}"
+        self._define(overlay_key, Symbol(
+            name=sys.intern(base.lower()),
+            kind=SymbolKind.OVERLAY,
+            data_type="OVERLAY",
+            line=line,
+            column=col,
+            documentation=f"Overlay on {base}"
+        ))
+
+    def _data_type(self, data_type: str) -> str:
+        """Get the shared copy of a data type string"""
+        return self._data_types.setdefault(data_type, data_type)
+
+    def _define(self, key: str, symbol: Symbol) -> None:
+        """Record a declaration, which replaces any earlier one of that key"""
+        self.symbols[key] = symbol
+        self._definitions.setdefault(key, []).append(symbol)
+
+    def _declare_label(self, name: str, line: int, col: int) -> None:
         """
-        Parse labels - identifiers followed by colon before a statement
+        Labels - identifiers followed by colon before a statement
         label: statement
         """
-        # Labels are identifiers followed by : but not :=
-        pattern = r'\b([a-zA-Z][a-zA-Z0-9]*)\s*:(?!=)'
-        for match in re.finditer(pattern, text):
-            label_name = match.group(1)
-            # Skip if it looks like a parameter specification
-            if label_name.upper() in self.KEYWORDS:
-                continue
-
-            line, col = self._find_position(text, match.start())
-            # Don't override existing symbols
-            if label_name.lower() not in self.symbols:
-                self.symbols[label_name.lower()] = Symbol(
-                    name=label_name.lower(),
-                    kind=SymbolKind.LABEL,
-                    data_type="LABEL",
-                    line=line,
-                    column=col,
-                    documentation="Label"
-                )
-
-    def _parse_references(self, text: str) -> None:
-        """Parse all identifier references in the code"""
-        # Find all identifiers (lowercase letters followed by alphanumerics)
-        pattern = r'\b([a-zA-Z][a-zA-Z0-9]*)\b'
-        for match in re.finditer(pattern, text):
-            name = match.group(1)
-            # Skip keywords
-            if name.upper() in self.KEYWORDS:
-                continue
+        label = Symbol(
+            name=name,
+            kind=SymbolKind.LABEL,
+            data_type="LABEL",
+            line=line,
+            column=col,
+            documentation="Label"
+        )
+        self._definitions.setdefault(name, []).append(label)
+
+        # Don't override declarations, wherever they appear
+        if name not in self.symbols:
+            self.symbols[name] = label
+
+    # Declaration handlers by master pattern alternative
+    _DECLARATION_HANDLERS = {
+        'table': _declare_table,
+        'switch': _declare_switch,
+        'overlay': _declare_overlay,
+        'array': _declare_array,
+        'procedure': _declare_procedure,
+        'number': _declare_number,
+    }
 
-            line, col = self._find_position(text, match.start())
-            self.references.append(Reference(
-                name=name.lower(),
-                line=line,
-                column=col,
-                end_column=col + len(name)
-            ))
+    def get_line(self, line: int) -> Optional[str]:
+        """Get the text of a line, without its newline"""
+        if line >= len(self.line_starts):
+            return None
+        start = self.line_starts[line]
+        if line + 1 < len(self.line_starts):
+            return self.text[start:self.line_starts[line + 1] - 1]
+        return self.text[start:]
 
     def get_symbols(self) -> Dict[str, Symbol]:
         """Get all parsed symbols"""
@@ -482,24 +663,20 @@ class CORAL66Parser:
 
     def get_references(self) -> List[Reference]:
         """Get all references"""
-        return self.references
+        refs = self.references
+        return [
+            Reference(name=name, line=line, column=column, end_column=end_column)
+            for name, line, column, end_column
+            in zip(refs.names, refs.lines, refs.columns, refs.end_columns)
+        ]
 
     def get_diagnostics(self) -> List[Diagnostic]:
         """Get all diagnostics"""
         return self.diagnostics
 
-    def get_completions(self, line: int, column: int) -> List[Dict]:
-        """Get completion items at position"""
-        completions = []
-
-        # Add keywords
-        for kw in sorted(self.KEYWORDS):
-            completions.append({
-                'label': kw,
-                'kind': 'keyword',
-                'detail': 'CORAL 66 keyword',
-                'documentation': f"CORAL 66 keyword: {kw}"
-            })
+    def _build_completion_index(self) -> None:
+        """Build the completion items and a sorted index of their labels"""
+        completions = list(self._KEYWORD_COMPLETIONS)
 
         # Add symbols
         for name, sym in self.symbols.items():
@@ -512,107 +689,205 @@ class CORAL66Parser:
                 'documentation': sym.documentation
             })
 
-        return completions
+        # The keywords are already in order, so only the symbols need sorting
+        keywords = len(self._KEYWORD_COMPLETIONS)
+        by_label = list(merge(
+            self._KEYWORD_COMPLETIONS,
+            sorted(completions[keywords:], key=lambda c: c['label'].lower()),
+            key=lambda c: c['label'].lower()
+        ))
+        self._completions = completions
+        self._completions_by_label = by_label
+        self._completion_labels = [c['label'].lower() for c in by_label]
+
+    def completion_prefix(self, line: int, column: int) -> str:
+        """Get the part of an identifier typed before a position"""
+        line_text = self.get_line(line)
+        if line_text:
+            prefix_match = IDENTIFIER_PREFIX_RE.search(line_text[:column])
+            if prefix_match:
+                return prefix_match.group()
+        return ''
 
-    def get_hover(self, line: int, column: int) -> Optional[Dict]:
-        """Get hover information at position"""
-        if line >= len(self.lines):
+    def get_completions(self, line: int, column: int) -> List[Dict]:
+        """
+        Get completion items at position
+
+        Once an identifier is being typed, only items starting with its
+        first letter are returned; the editor filters the rest as it types.
+        """
+        if self._completions is None:
+            self._build_completion_index()
+
+        prefix = self.completion_prefix(line, column)
+        if not prefix:
+            return list(self._completions)
+
+        # Labels sharing a first letter sit together in the sorted index
+        prefix = prefix[0].lower()
+        start = bisect_left(self._completion_labels, prefix)
+        end = bisect_right(self._completion_labels, prefix + '\uffff', start)
+        return self._completions_by_label[start:end]
+
+    def _resolve(self, line: int, column: int) -> Optional[str]:
+        """
+        Find the identifier at a position
+
+        Editors tend to ask for hover, definition and references at the
+        same spot in quick succession, so recent answers are remembered.
+        """
+        key = (line, column)
+        if key in self._resolved:
+            self._resolved.move_to_end(key)
+            return self._resolved[key]
+
+        word = None
+        if 0 <= line < len(self.line_starts):
+            word = self._word_at(line, column)
+
+        self._resolved[key] = word
+        if len(self._resolved) > self._RESOLVED_LIMIT:
+            self._resolved.popitem(last=False)
+        return word
+
+    def _word_at(self, line: int, column: int) -> Optional[str]:
+        """
+        Find the identifier touching a column of a line
+
+        Expands outwards from the column within the document text, without
+        copying the line out, accepting the same words as the scan: a run
+        of letters and digits that starts with a letter and is not joined
+        to other word characters such as underscores.
+        """
+        text = self.text
+        line_start = self.line_starts[line]
+        if line + 1 < len(self.line_starts):
+            line_end = self.line_starts[line + 1] - 1
+        else:
+            line_end = len(text)
+        offset = line_start + column
+        if not line_start <= offset <= line_end:
+            return None
+
+        start = offset
+        while start > line_start and text[start - 1] in _IDENT_CHARS:
+            start -= 1
+        end = offset
+        while end < line_end and text[end] in _IDENT_CHARS:
+            end += 1
+
+        if start == end or not text[start].isalpha():
             return None
+        for i in (start - 1, end):
+            if line_start <= i < line_end and (text[i].isalnum() or text[i] == '_'):
+                return None
+        return text[start:end]
 
-        line_text = self.lines[line]
+    def _symbol_at(self, name: str, line: int) -> Optional[Symbol]:
+        """
+        Find the declaration of a name that applies on a line
 
-        # Find the word at this position
-        word_match = None
-        for match in re.finditer(r'\b([a-zA-Z][a-zA-Z0-9]*)\b', line_text):
-            if match.start() <= column <= match.end():
-                word_match = match
+        Nested blocks often declare the same name again, so when there is
+        more than one declaration, the closest one above the line is used,
+        or the first one when they all come later.
+        """
+        definitions = self._definitions.get(name)
+        if not definitions:
+            return None
+
+        found = definitions[0]
+        for sym in definitions[1:]:
+            if sym.line > line:
                 break
+            found = sym
+        return found
 
-        if not word_match:
+    def get_hover(self, line: int, column: int) -> Optional[Dict]:
+        """Get hover information at position"""
+        word = self._resolve(line, column)
+        if not word:
             return None
 
-        word = word_match.group(1)
+        name = word.lower()
 
         # Check if it's a keyword
-        if word.upper() in self.KEYWORDS:
-            return {
-                'contents': f"**{word.upper()}**\n\nCORAL 66 keyword"
-            }
+        if name in self._KEYWORD_HOVERS:
+            return self._KEYWORD_HOVERS[name]
 
         # Check if it's a symbol
-        if word.lower() in self.symbols:
-            sym = self.symbols[word.lower()]
-            return {
-                'contents': f"**{sym.name}**: {sym.data_type}\n\n{sym.documentation}"
-            }
+        sym = self._symbol_at(name, line)
+        if sym:
+            return sym.hover
 
         return None
 
     def get_definition(self, line: int, column: int) -> Optional[Dict]:
         """Get definition location for symbol at position"""
-        if line >= len(self.lines):
-            return None
-
-        line_text = self.lines[line]
-
-        # Find the word at this position
-        for match in re.finditer(r'\b([a-zA-Z][a-zA-Z0-9]*)\b', line_text):
-            if match.start() <= column <= match.end():
-                word = match.group(1).lower()
-                if word in self.symbols:
-                    sym = self.symbols[word]
-                    return {
-                        'line': sym.line,
-                        'column': sym.column,
-                        'name': sym.name
-                    }
-                break
+        word = self._resolve(line, column)
+        sym = self._symbol_at(word.lower(), line) if word else None
+        if sym:
+            return sym.definition
 
         return None
 
     def get_references_at(self, line: int, column: int) -> List[Dict]:
         """Get all references to symbol at position"""
-        if line >= len(self.lines):
-            return []
-
-        line_text = self.lines[line]
-
-        # Find the word at this position
-        target_word = None
-        for match in re.finditer(r'\b([a-zA-Z][a-zA-Z0-9]*)\b', line_text):
-            if match.start() <= column <= match.end():
-                target_word = match.group(1).lower()
-                break
-
-        if not target_word:
+        word = self._resolve(line, column)
+        if not word:
             return []
+        target_word = word.lower()
+
+        # Index every name's references the first time any is asked for
+        if self._refs_by_name is None:
+            by_name: Dict[str, List[int]] = {}
+            for i, name in enumerate(self.references.names):
+                by_name.setdefault(name, []).append(i)
+            self._refs_by_name = by_name
+
+        references = self.references
+        return [
+            {
+                'line': references.lines[i],
+                'column': references.columns[i],
+                'end_column': references.end_columns[i]
+            }
+            for i in self._refs_by_name.get(target_word, ())
+        ]
 
-        # Find all references to this word
-        refs = []
-        for ref in self.references:
-            if ref.name == target_word:
-                refs.append({
-                    'line': ref.line,
-                    'column': ref.column,
-                    'end_column': ref.end_column
-                })
-
-        return refs
+    def get_symbol_table(self) -> SymbolTable:
+        """Get the top-level symbols for the outline as parallel columns"""
+        # The outline only changes when the document is parsed again
+        if self._symbol_table is None:
+            ordered = sorted(
+                (sym for name, sym in self.symbols.items() if '.' not in name),  # Skip nested symbols
+                key=lambda sym: sym.line
+            )
+            self._symbol_table = SymbolTable(
+                names=[sym.name for sym in ordered],
+                kinds=[sym.kind.value for sym in ordered],
+                details=[sym.data_type for sym in ordered],
+                lines=[sym.line for sym in ordered],
+                columns=[sym.column for sym in ordered],
+            )
+        return self._symbol_table
 
     def get_document_symbols(self) -> List[Dict]:
         """Get all document symbols for outline"""
-        symbols = []
-        for name, sym in self.symbols.items():
-            if '.' in name:  # Skip nested symbols
-                continue
-            symbols.append({
-                'name': sym.name,
-                'kind': sym.kind.value,
-                'detail': sym.data_type,
-                'line': sym.line,
-                'column': sym.column
-            })
-        return sorted(symbols, key=lambda x: x['line'])
+        if self._document_symbols is None:
+            table = self.get_symbol_table()
+            self._document_symbols = [
+                {
+                    'name': name,
+                    'kind': kind,
+                    'detail': detail,
+                    'line': line,
+                    'column': column
+                }
+                for name, kind, detail, line, column in zip(
+                    table.names, table.kinds, table.details, table.lines, table.columns
+                )
+            ]
+        return self._document_symbols
 
 
 def main():